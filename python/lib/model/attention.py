@@ -1,8 +1,28 @@
-from typing import NamedTuple
-
 import torch
 import torch.nn.functional as nnf
 from torch import nn
+from torch.nn.attention.flex_attention import flex_attention
+
+from lib.model import flash_triton
+
+# flex_attention is only fast once compiled, cache the compiled callable
+# (shape specializations are cached internally by torch.compile)
+_compiled_flex_attention = None
+
+
+def _flex_attention(q, k, v, score_mod, scale: float):
+    global _compiled_flex_attention
+    if _compiled_flex_attention is None:
+        _compiled_flex_attention = torch.compile(flex_attention, dynamic=True)
+    return _compiled_flex_attention(q, k, v, score_mod=score_mod, scale=scale)
+
+
+@torch.compile(dynamic=True)
+def _encoder_step(encoder, params, input):
+    # compiled once and shared by every layer in the tower: functional_call feeds the
+    # parameters in as plain inputs, so all depth iterations hit the same graph instead
+    # of paying one inductor compilation per EncoderLayer instance
+    return torch.func.functional_call(encoder, params, (input,))
 
 
 class AttentionTower(nn.Module):
@@ -11,11 +31,14 @@ class AttentionTower(nn.Module):
             board_size: int, input_channels: int,
             depth: int,
             d_model: int, heads: int, d_k: int, d_v: int, d_ff: int,
-            dropout: float
+            dropout: float,
+            compile: bool = True,
+            use_amp: bool = False
     ):
         super().__init__()
         self.board_size = board_size
         self.d_model = d_model
+        self.use_amp = use_amp
 
         alpha = (2 * depth) ** (1 / 4)
         beta = (8 * depth) ** (-1 / 4)
@@ -28,21 +51,115 @@ class AttentionTower(nn.Module):
             for _ in range(depth)
         )
 
+        # if set, forward runs the layers through the shared compiled _encoder_step
+        # only forward is compiled, the weight-returning path would break the sdpa fusion
+        self.compile_encoders = compile
+
+        # set by graph_encoders, replays the whole depth loop without per-kernel launches
+        self.graphed_encoders = None
+
+        # per-layer parameter dicts for _encoder_step, built lazily on the first
+        # compiled forward instead of once per layer per call
+        self._encoder_params = None
+
+    def graph_encoders(self, sample_input):
+        # capture every encoder layer (forward and backward) into cuda graphs, removing the
+        # per-kernel launch overhead of the depth loop. requires static shapes: sample_input
+        # must be a cuda (n, b, d_model) activation with the exact shape used afterwards,
+        # and the capture must be redone if the batch size changes
+        assert sample_input.is_cuda, "cuda graph capture requires a cuda sample input"
+
+        # replaying a graph ignores any surrounding autocast context, so the capture and
+        # the replays would silently run in different dtypes
+        assert not self.use_amp, "cuda graphs and use_amp don't compose, capture inside autocast instead"
+
+        # the samples must require grad, otherwise the captured backward never produces an
+        # input gradient and every layer above the first would stop training
+        sample_args = tuple((sample_input.clone().requires_grad_(True),) for _ in self.encoders)
+        self.graphed_encoders = list(torch.cuda.make_graphed_callables(tuple(self.encoders), sample_args))
+
     def forward(self, x):
+        # everything behind the is_scripting/is_tracing guards is eager-python only (dynamo,
+        # amp, cuda graphs), so torch.jit.script/trace and onnx export see the plain formulation
+        if not torch.jit.is_scripting() and not torch.jit.is_tracing() and self.use_amp:
+            return self._forward_amp(x)
+
+        return self.forward_inner(x)
+
+    @torch.jit.unused
+    def _forward_amp(self, x):
+        # run matmuls (projections, attention, ff) in bf16 on tensor cores,
+        # autocast itself keeps layer_norm and softmax in fp32
+        with torch.autocast(x.device.type, dtype=torch.bfloat16):
+            result = self.forward_inner(x)
+        return result.to(x.dtype)
+
+    @torch.jit.unused
+    def forward_flex(self, x, score_mod):
+        # like forward, but applies a flex_attention score_mod (eg. a board-position
+        # bias) in every layer; eager-python only, not scriptable or exportable
+        b, _, h, w = x.shape
+        curr = self._embed(x)
+
+        for encoder in self.encoders:
+            curr = encoder.forward_flex(curr, score_mod)
+
+        return self._unembed(curr, b, h, w)
+
+    def forward_inner(self, x):
+        b, _, h, w = x.shape
+        curr = self._embed(x)
+
+        if torch.jit.is_scripting() or torch.jit.is_tracing():
+            for encoder in self.encoders:
+                curr = encoder(curr)
+        elif self.graphed_encoders is not None:
+            curr = self._encode_graphed(curr)
+        elif self.compile_encoders:
+            curr = self._encode_compiled(curr)
+        else:
+            for encoder in self.encoders:
+                curr = encoder(curr)
+
+        return self._unembed(curr, b, h, w)
+
+    def _embed(self, x):
         b, d_in, h, w = x.shape
 
         # "b c h w -> (h w) b c"
         shaped = x.permute(2, 3, 0, 1).view(h * w, b, d_in)
 
         expanded = self.expand(shaped.reshape(h * w * b, d_in)).view(h * w, b, self.d_model)
-        curr = expanded + self.embedding.unsqueeze(1)
 
-        for encoder in self.encoders:
-            curr = encoder(curr)
+        if self.training:
+            curr = expanded + self.embedding.unsqueeze(1)
+        else:
+            # expanded is freshly allocated by the projection, so during inference the
+            # embedding can be added in-place, saving a full activation round-trip
+            curr = expanded.add_(self.embedding.unsqueeze(1))
 
+        return curr
+
+    def _unembed(self, curr, b: int, h: int, w: int):
         # "(h w) b c -> b c h w"
-        reshaped = curr.view((h, w, b, self.d_model)).permute((2, 3, 0, 1))
-        return reshaped
+        return curr.view((h, w, b, self.d_model)).permute((2, 3, 0, 1))
+
+    @torch.jit.unused
+    def _encode_graphed(self, curr):
+        for encoder in self.graphed_encoders:
+            curr = encoder(curr)
+        return curr
+
+    @torch.jit.unused
+    def _encode_compiled(self, curr):
+        # the dicts stay valid across .to()/optimizer steps since Module._apply
+        # swaps parameter data in-place
+        if self._encoder_params is None:
+            self._encoder_params = [dict(encoder.named_parameters()) for encoder in self.encoders]
+
+        for encoder, params in zip(self.encoders, self._encoder_params):
+            curr = _encoder_step(encoder, params, curr)
+        return curr
 
 
 class EncoderLayer(nn.Module):
@@ -67,15 +184,14 @@ class EncoderLayer(nn.Module):
         self.d_kqv = 2 * d_k + d_v
         self.d_k_total = heads * self.d_k
 
+        # folded into q before the logit matmul, so the logits never need a separate scaling pass
+        self.scale = d_k ** -0.5
+
         # build inner layers
         self.project_qkv = nn.Linear(d_model, heads * self.d_kqv, bias=False)
         self.project_out = nn.Linear(heads * d_v, d_model, bias=False)
 
-        self.ff = nn.Sequential(
-            nn.Linear(d_model, d_ff, bias=False),
-            nn.ReLU(),
-            nn.Linear(d_ff, d_model, bias=False),
-        )
+        self.ff = FeedForward(d_model, d_ff)
 
         self.dropout = nn.Dropout(dropout)
         self.norm_att = nn.LayerNorm(d_model, elementwise_affine=False)
@@ -88,7 +204,7 @@ class EncoderLayer(nn.Module):
         project_k = self.project_qkv.weight[self.d_k_total:2 * self.d_k_total, :]
         project_v = self.project_qkv.weight[2 * self.d_k_total:, :]
 
-        for w in [self.ff[0].weight, self.ff[2].weight, project_v, self.project_out.weight]:
+        for w in [self.ff.lin1.weight, self.ff.lin2.weight, project_v, self.project_out.weight]:
             nn.init.xavier_normal_(w, gain=beta)
         for w in [project_q, project_k]:
             nn.init.xavier_normal_(w, gain=1)
@@ -100,57 +216,106 @@ class EncoderLayer(nn.Module):
         (n, b, c) = input.shape
         assert c == self.d_model
 
-        # input projection
-        qkv = self.project_qkv(input.view(n * b, self.d_model)).view(n, b * heads, self.d_kqv)
-
-        # split
-        q = qkv[:, :, :self.d_k]
-        k = qkv[:, :, self.d_k:2 * self.d_k]
-        v = qkv[:, :, 2 * self.d_k:]
+        # input projection & split, same (b, h, n, d) layout as forward
+        qkv = self.project_qkv(input.view(n * b, self.d_model)).view(n, b, heads, self.d_kqv).permute(1, 2, 0, 3)
+        q, k, v = qkv.split([self.d_k, self.d_k, self.d_v], dim=-1)
 
         # main attention calculation
-        # weights: (b*h, n_q, n_k)
-        # att_raw: (n_q, b*h, d_v)
-
-        # TODO add scale factor
-        logits = torch.bmm(q.transpose(0, 1), k.transpose(0, 1).transpose(1, 2))
-        weights = nnf.softmax(logits, -1)
-
-        # this contiguous() is not actually necessary if we could set the output strides
-        att_raw = torch.bmm(weights, v.transpose(0, 1)).transpose(0, 1).contiguous()
-
-        att_viewed = att_raw.view(n * b, heads * self.d_v)
+        # the k transpose is just a stride flip, matmul never copies it
+        logits = torch.matmul(q * self.scale, k.transpose(-1, -2))
+
+        if logits.requires_grad:
+            weights = nnf.softmax(logits, -1)
+        else:
+            # in-place softmax reusing the logits buffer, halving peak memory of the
+            # (b, h, n, n) tensor; not autograd-safe, hence the guard
+            logits.sub_(logits.amax(-1, keepdim=True)).exp_()
+            weights = logits.div_(logits.sum(-1, keepdim=True))
+
+        # "b h n dv -> n b (h dv)", the reshape is the only copy on this path
+        att_raw = torch.matmul(weights, v)
+        att_viewed = att_raw.permute(2, 0, 1, 3).reshape(n * b, heads * self.d_v)
         att_projected = self.project_out(att_viewed).view(n, b, self.d_model)
         att_result = self.norm_att(input * self.alpha + self.dropout(att_projected))
 
         ff_inner = self.ff(att_result.view(n * b, self.d_model)).view(n, b, self.d_model)
         ff_result = self.norm_ff(att_result * self.alpha + self.dropout(ff_inner))
 
-        return ff_result, weights
+        # weights: (b*h, n_q, n_k), the view is free since softmax output is contiguous
+        return ff_result, weights.view(b * heads, n, n)
 
     def forward(self, input):
-        result, _ = self.forward_with_weights(input)
-        return result
+        # input & output: (n, b, d_model)
+        # fast path: fused attention kernel, never materializes the (n, n) weight matrix
+        # use forward_with_weights instead if the attention weights are needed
+
+        (n, b, c) = input.shape
+        assert c == self.d_model
+
+        q, k, v = self._project_qkv(input, n, b)
+
+        if not torch.jit.is_scripting() and not torch.jit.is_tracing() and self._use_triton(q):
+            att = self._attention_triton(q, k, v)
+        else:
+            att = nnf.scaled_dot_product_attention(q, k, v, dropout_p=0.0, is_causal=False, scale=1.0)
+
+        return self._finish(input, att, n, b)
+
+    @torch.jit.unused
+    def forward_flex(self, input, score_mod):
+        # fast path variant that applies a flex_attention score_mod, eg. a
+        # board-position bias; eager-python only, not scriptable or exportable
+
+        (n, b, c) = input.shape
+        assert c == self.d_model
 
+        q, k, v = self._project_qkv(input, n, b)
+        att = _flex_attention(q, k, v, score_mod, scale=1.0)
 
-class AttShapes(NamedTuple):
-    b: int  # batch size
-    n: int  # input sequence length (for k and v)
-    m: int  # output sequence length (for q)
-    heads: int  # the number of heads
-    dk: int  # key size per head (for q and k)
-    dv: int  # value size per head
+        return self._finish(input, att, n, b)
 
+    @torch.jit.unused
+    def _use_triton(self, q) -> bool:
+        return flash_triton.enabled(q)
 
-def check_att_shapes(q, k, v, heads: int) -> AttShapes:
-    m, b0, dk_total0 = q.shape
-    n0, b1, dk_total1 = k.shape
-    n1, b2, dv_total = v.shape
+    @torch.jit.unused
+    def _attention_triton(self, q, k, v):
+        return flash_triton.attention(q, k, v, scale=1.0)
 
-    assert b0 == b1 == b2, "Batch size mismatch"
-    assert n0 == n1, "Input seq length mismatch"
-    assert dk_total0 == dk_total1, "Key size mismatch"
+    def _project_qkv(self, input, n: int, b: int):
+        # input projection, then a single permute into the (b, h, n, d) layout expected
+        # by the attention kernels; the slices are all still stride-1 in the last dim
+        qkv = self.project_qkv(input.view(n * b, self.d_model)).view(n, b, self.heads, self.d_kqv).permute(1, 2, 0, 3)
+
+        # q is pre-scaled, so the kernels must not scale again
+        q = qkv[:, :, :, :self.d_k] * self.scale
+        k = qkv[:, :, :, self.d_k:2 * self.d_k]
+        v = qkv[:, :, :, 2 * self.d_k:]
+
+        return q, k, v
+
+    def _finish(self, input, att, n: int, b: int):
+        # "b h n dv -> n b (h dv)"
+        att_viewed = att.permute(2, 0, 1, 3).reshape(n * b, self.heads * self.d_v)
+        att_projected = self.project_out(att_viewed).view(n, b, self.d_model)
+        att_result = self.norm_att(input * self.alpha + self.dropout(att_projected))
+
+        ff_inner = self.ff(att_result.view(n * b, self.d_model)).view(n, b, self.d_model)
+        ff_result = self.norm_ff(att_result * self.alpha + self.dropout(ff_inner))
+
+        return ff_result
+
+
+class FeedForward(nn.Module):
+    # Linear -> ReLU -> Linear (no biases)
+    # when the tower runs with compile=True, inductor fuses the relu into the
+    # first matmul's epilogue, so the (.., d_ff) intermediate never hits HBM
+    def __init__(self, d_model: int, d_ff: int):
+        super().__init__()
+        self.lin1 = nn.Linear(d_model, d_ff, bias=False)
+        self.lin2 = nn.Linear(d_ff, d_model, bias=False)
+
+    def forward(self, input):
+        return self.lin2(nnf.relu(self.lin1(input)))
 
-    assert dk_total0 % heads == 0 and dv_total % heads == 0, "Size not divisible by heads"
 
-    return AttShapes(b=b0, n=n0, m=m, heads=heads, dk=dk_total0 // heads, dv=dv_total // heads)
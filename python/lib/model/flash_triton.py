@@ -0,0 +1,162 @@
+"""
+Fused attention forward kernel written in Triton, as a hackable alternative to
+scaled_dot_product_attention (eg. for experimenting with the inner loop or for
+setups where the sdpa flash kernels are unavailable).
+
+The forward pass uses the usual tiled online-softmax formulation and never
+materializes the (n, n) logits matrix. The backward pass recomputes the
+attention weights with plain torch ops instead of a handwritten kernel, so the
+(n, n) tensor only exists transiently during backward.
+
+Off by default: set ENABLED = True to make EncoderLayer.forward dispatch here
+on CUDA instead of scaled_dot_product_attention.
+"""
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+
+    TRITON_AVAILABLE = True
+except ImportError:
+    TRITON_AVAILABLE = False
+
+ENABLED = False
+
+
+def available() -> bool:
+    return TRITON_AVAILABLE and torch.cuda.is_available()
+
+
+# tl.dot rejects blocks smaller than 16, so head dims below that can't run the kernel
+MIN_HEAD_DIM = 16
+
+
+def enabled(q) -> bool:
+    return ENABLED and q.is_cuda and q.shape[-1] >= MIN_HEAD_DIM and available()
+
+
+def attention(q, k, v, scale: float):
+    # q, k: (b, h, n, d_k), v: (b, h, n, d_v), output: (b, h, n, d_v)
+    assert q.shape[-1] >= MIN_HEAD_DIM and v.shape[-1] >= MIN_HEAD_DIM, \
+        f"head dims must be >= {MIN_HEAD_DIM} for tl.dot, got d_k={q.shape[-1]}, d_v={v.shape[-1]}"
+
+    return _FlashAttention.apply(q, k, v, scale)
+
+
+if TRITON_AVAILABLE:
+    @triton.autotune(
+        configs=[
+            triton.Config({"BLOCK_M": block_m, "BLOCK_N": block_n}, num_warps=num_warps)
+            for block_m in [32, 64]
+            for block_n in [32, 64]
+            for num_warps in [2, 4]
+        ],
+        key=["N", "DK", "DV"],
+    )
+    @triton.jit
+    def _attn_fwd(
+            q_ptr, k_ptr, v_ptr, o_ptr,
+            scale,
+            N,
+            DK: tl.constexpr, DV: tl.constexpr,
+            BLOCK_DK: tl.constexpr, BLOCK_DV: tl.constexpr,
+            BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr,
+    ):
+        # one program per (query block, batch*head), inputs are contiguous (b*h, n, d)
+        pid_m = tl.program_id(0)
+        pid_b = tl.program_id(1)
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_dk = tl.arange(0, BLOCK_DK)
+        offs_dv = tl.arange(0, BLOCK_DV)
+
+        q = tl.load(
+            q_ptr + pid_b * N * DK + offs_m[:, None] * DK + offs_dk[None, :],
+            mask=(offs_m[:, None] < N) & (offs_dk[None, :] < DK), other=0.0,
+        )
+
+        # online softmax state: running max, running sum, unnormalized accumulator
+        m_i = tl.full([BLOCK_M], float("-inf"), tl.float32)
+        l_i = tl.zeros([BLOCK_M], tl.float32)
+        acc = tl.zeros([BLOCK_M, BLOCK_DV], tl.float32)
+
+        for start_n in range(0, N, BLOCK_N):
+            offs_n = start_n + tl.arange(0, BLOCK_N)
+
+            k = tl.load(
+                k_ptr + pid_b * N * DK + offs_n[:, None] * DK + offs_dk[None, :],
+                mask=(offs_n[:, None] < N) & (offs_dk[None, :] < DK), other=0.0,
+            )
+            logits = tl.dot(q, tl.trans(k)) * scale
+            logits = tl.where(offs_n[None, :] < N, logits, float("-inf"))
+
+            m_new = tl.maximum(m_i, tl.max(logits, 1))
+            p = tl.exp(logits - m_new[:, None])
+            correction = tl.exp(m_i - m_new)
+
+            l_i = l_i * correction + tl.sum(p, 1)
+            acc = acc * correction[:, None]
+
+            v = tl.load(
+                v_ptr + pid_b * N * DV + offs_n[:, None] * DV + offs_dv[None, :],
+                mask=(offs_n[:, None] < N) & (offs_dv[None, :] < DV), other=0.0,
+            )
+            acc += tl.dot(p.to(v.dtype), v)
+            m_i = m_new
+
+        acc = acc / l_i[:, None]
+        tl.store(
+            o_ptr + pid_b * N * DV + offs_m[:, None] * DV + offs_dv[None, :],
+            acc,
+            mask=(offs_m[:, None] < N) & (offs_dv[None, :] < DV),
+        )
+
+
+def _attention_fwd(q, k, v, scale: float):
+    (b, h, n, d_k) = q.shape
+    d_v = v.shape[-1]
+
+    q3 = q.reshape(b * h, n, d_k).contiguous()
+    k3 = k.reshape(b * h, n, d_k).contiguous()
+    v3 = v.reshape(b * h, n, d_v).contiguous()
+    out = torch.empty(b * h, n, d_v, device=q.device, dtype=q.dtype)
+
+    grid = lambda meta: (triton.cdiv(n, meta["BLOCK_M"]), b * h)
+    _attn_fwd[grid](
+        q3, k3, v3, out,
+        scale, n,
+        DK=d_k, DV=d_v,
+        BLOCK_DK=triton.next_power_of_2(d_k),
+        BLOCK_DV=triton.next_power_of_2(d_v),
+    )
+
+    return out.view(b, h, n, d_v)
+
+
+class _FlashAttention(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, q, k, v, scale: float):
+        out = _attention_fwd(q, k, v, scale)
+        ctx.save_for_backward(q, k, v)
+        ctx.scale = scale
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        q, k, v = ctx.saved_tensors
+        scale = ctx.scale
+
+        # recompute the weights, then standard attention + softmax backward
+        logits = torch.matmul(q * scale, k.transpose(-1, -2))
+        weights = torch.softmax(logits, -1)
+
+        grad_v = torch.matmul(weights.transpose(-1, -2), grad_out)
+        grad_weights = torch.matmul(grad_out, v.transpose(-1, -2))
+        grad_logits = (grad_weights - (grad_weights * weights).sum(-1, keepdim=True)) * weights
+
+        grad_q = torch.matmul(grad_logits, k) * scale
+        grad_k = torch.matmul(grad_logits.transpose(-1, -2), q) * scale
+
+        return grad_q, grad_k, grad_v, None
@@ -115,7 +115,10 @@ def save_onnx_inner(
             input_names=input_names,
             output_names=output_names,
             dynamic_axes={k: batch_axis for k in input_names + output_names},
-            opset_version=10,
+            # opset 14 is the first with scaled_dot_product_attention;
+            # pin the torchscript exporter, the dynamo one silently keeps opset 18
+            opset_version=14,
+            dynamo=False,
         )
 
     # move the network back to the original device
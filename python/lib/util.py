@@ -11,6 +11,13 @@ from torch import nn
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 PIN_MEMORY = False
 
+if torch.cuda.is_available():
+    # shapes are fixed per run, so let cudnn autotune its conv algorithms,
+    # and allow tf32 tensor cores for fp32 matmuls/convs
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
 
 def prod(values):
     result = 1